@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import hashlib
+
+BUNDLE_DIR = ".bundles"
+INDEX_FILE = "index.json"
+DEFAULT_THRESHOLD = 4096
+MAX_BUNDLE_SIZE = 64 * 1024 * 1024
+
+# Packed backup layout.
+# Files smaller than the threshold are appended to bundle files inside the ".bundles" folder of the backup,
+# and an index keeps track of where each one lives. Bigger files are still stored as regular files.
+# This saves one inode and a handful of syscalls per small file on the backup side.
+class BundleStore:
+
+	def __init__(self, backup, threshold=DEFAULT_THRESHOLD):
+		self.backup = backup
+		self.threshold = threshold
+		self.bundle_dir = os.path.join(backup, BUNDLE_DIR)
+		self.index_file = os.path.join(self.bundle_dir, INDEX_FILE)
+		self.index = {"current": None, "files": {}}
+		self.handle = None
+		self.changed = False
+		self.load_index()
+
+	def get_backup(self):
+		return self.backup
+
+	def get_threshold(self):
+		return self.threshold
+
+	def get_files(self):
+		return list(self.index["files"].keys())
+
+	def load_index(self):
+		if os.path.exists(self.index_file):
+			with open(self.index_file, 'r', encoding='utf-8') as f:
+				self.index = json.load(f)
+
+	# The index is written to a temporary file first so an interrupted sync never leaves it half written.
+	# Bytes appended to a bundle without an index entry are simply ignored.
+	def save_index(self):
+		if not os.path.exists(self.bundle_dir):
+			os.makedirs(self.bundle_dir)
+		temp_file = self.index_file + ".tmp"
+		with open(temp_file, 'w', encoding='utf-8') as f:
+			json.dump(self.index, f, ensure_ascii=False)
+		os.replace(temp_file, self.index_file)
+
+	def is_small(self, size):
+		return size < self.threshold
+
+	def contains(self, relative_file):
+		return relative_file in self.index["files"]
+
+	def get_entry(self, relative_file):
+		return self.index["files"].get(relative_file)
+
+	# Compares the stat of the source file with the recorded one, so unchanged files are never read
+	def is_current(self, relative_file, stat):
+		entry = self.get_entry(relative_file)
+		return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+	def open_bundle(self):
+		current = self.index["current"]
+		if current is not None and self.handle is not None and self.handle.tell() < MAX_BUNDLE_SIZE:
+			return current
+
+		if self.handle is not None:
+			self.handle.close()
+			self.handle = None
+
+		if not os.path.exists(self.bundle_dir):
+			os.makedirs(self.bundle_dir)
+
+		# Keep appending to the current bundle until it's full, then roll over to a new one
+		if current is None or os.path.getsize(os.path.join(self.bundle_dir, current)) >= MAX_BUNDLE_SIZE:
+			current = f"bundle_{self.next_bundle_number():06d}.pack"
+			self.index["current"] = current
+
+		self.handle = open(os.path.join(self.bundle_dir, current), "ab")
+		return current
+
+	def next_bundle_number(self):
+		numbers = [int(name[7:13]) for name in os.listdir(self.bundle_dir) if name.startswith("bundle_") and name.endswith(".pack")]
+		return max(numbers) + 1 if numbers else 0
+
+	def add(self, relative_file, source_file, stat):
+		with open(source_file, "rb") as f:
+			data = f.read()
+		bundle = self.open_bundle()
+		offset = self.handle.tell()
+		self.handle.write(data)
+		self.index["files"][relative_file] = {
+			"bundle": bundle,
+			"offset": offset,
+			"size": len(data),
+			"mtime": stat.st_mtime_ns,
+			"checksum": hashlib.sha256(data).hexdigest()
+		}
+		self.changed = True
+
+	def remove(self, relative_file):
+		if self.index["files"].pop(relative_file, None) is not None:
+			self.changed = True
+
+	def move(self, relative_file, new_relative_file):
+		self.index["files"][new_relative_file] = self.index["files"].pop(relative_file)
+		self.changed = True
+
+	# Re-keys every bundled file below a folder that was renamed or moved
+	def move_tree(self, relative_path, new_relative_path):
+		prefix = relative_path + os.sep
+		for relative_file in [name for name in self.index["files"] if name.startswith(prefix)]:
+			self.move(relative_file, os.path.join(new_relative_path, relative_file[len(prefix):]))
+
+	def read(self, relative_file):
+		entry = self.index["files"][relative_file]
+		if self.handle is not None:
+			self.handle.flush()
+		with open(os.path.join(self.bundle_dir, entry["bundle"]), "rb") as f:
+			f.seek(entry["offset"])
+			return f.read(entry["size"])
+
+	# Bundles are append-only, so replaced and removed files leave dead bytes behind.
+	# Once those outweigh the live data, every live entry is rewritten into fresh bundles.
+	# The new bundles get new numbers and the old ones are only deleted after the new index is saved,
+	# so an interruption at any point leaves an index whose bundles all exist.
+	def compact(self):
+		bundles = [name for name in os.listdir(self.bundle_dir) if name.endswith(".pack")] if os.path.exists(self.bundle_dir) else []
+		total = sum(os.path.getsize(os.path.join(self.bundle_dir, name)) for name in bundles)
+		live = sum(entry["size"] for entry in self.index["files"].values())
+		if total <= 2 * live or total < MAX_BUNDLE_SIZE:
+			return False
+
+		if self.handle is not None:
+			self.handle.close()
+			self.handle = None
+
+		old_files = self.index["files"]
+		self.index["current"] = None
+		self.index["files"] = {}
+
+		# Entries are copied one at a time in bundle order, with a single old bundle open for reading at any point
+		reader = None
+		try:
+			for relative_file, entry in sorted(old_files.items(), key=lambda item: (item[1]["bundle"], item[1]["offset"])):
+				if reader is None or reader.name != os.path.join(self.bundle_dir, entry["bundle"]):
+					if reader is not None:
+						reader.close()
+					reader = open(os.path.join(self.bundle_dir, entry["bundle"]), "rb")
+				reader.seek(entry["offset"])
+				data = reader.read(entry["size"])
+
+				bundle = self.open_bundle()
+				offset = self.handle.tell()
+				self.handle.write(data)
+				self.index["files"][relative_file] = dict(entry, bundle=bundle, offset=offset)
+		finally:
+			if reader is not None:
+				reader.close()
+
+		if self.handle is not None:
+			self.handle.close()
+			self.handle = None
+		self.save_index()
+		self.changed = False
+
+		for name in bundles:
+			os.remove(os.path.join(self.bundle_dir, name))
+		return True
+
+	def close(self):
+		if self.handle is not None:
+			self.handle.close()
+			self.handle = None
+		if self.changed:
+			self.save_index()
+			self.changed = False
+
+	# Rebuilds a plain directory tree from a packed backup
+	def restore(self, target):
+		shutil.copytree(self.backup, target, ignore=shutil.ignore_patterns(BUNDLE_DIR), dirs_exist_ok=True)
+		for relative_file, entry in self.index["files"].items():
+			target_file = os.path.join(target, relative_file)
+			os.makedirs(os.path.dirname(target_file), exist_ok=True)
+			with open(target_file, "wb") as f:
+				f.write(self.read(relative_file))
+			os.utime(target_file, ns=(entry["mtime"], entry["mtime"]))
+
+def is_packed(directory):
+	return os.path.isdir(os.path.join(directory, BUNDLE_DIR))
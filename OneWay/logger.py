@@ -1,8 +1,33 @@
 import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener, MemoryHandler
+from queue import SimpleQueue
+
+# Formatting is left to the listener thread, so the sync loop only pays for putting the record on the queue
+class DeferredQueueHandler(QueueHandler):
+
+	def prepare(self, record):
+		return record
+
+# Per-file events are logged at DEBUG level. This keeps one in every `rate` of them and lets everything else through.
+class SampleFilter(logging.Filter):
+
+	def __init__(self, rate):
+		super().__init__()
+		self.rate = rate
+		self.seen = 0
+
+	def filter(self, record):
+		if record.levelno > logging.DEBUG:
+			return True
+		self.seen += 1
+		return (self.seen - 1) % self.rate == 0
 
 class Logger:
 
-	def __init__(self, log_file):
+	# queued: handlers run on a listener thread and file writes are batched, flushed by any INFO or higher record
+	# console_level and sample only apply to the console, the log file always gets every record
+	def __init__(self, log_file, queued=False, console_level="DEBUG", sample=1):
 		self.log_file = log_file
 		self.logger = logging.getLogger(__name__)
 		if self.logger.hasHandlers():
@@ -10,6 +35,11 @@ class Logger:
 				self.logger.removeHandler(handler)
 		self.file_handler = None
 		self.console_handler = None
+		self.queued = queued
+		self.console_level = console_level
+		self.sample = sample
+		self.buffer_handler = None
+		self.listener = None
 		self.format = logging.Formatter('[ONEWAY][%(asctime)s - %(name)s - %(levelname)s] - %(message)s')
 		self.setup()
 
@@ -25,6 +55,9 @@ class Logger:
 	def get_console_handler(self):
 		return self.console_handler
 
+	def get_listener(self):
+		return self.listener
+
 	def get_format(self):
 		return self.format
 
@@ -39,12 +72,32 @@ class Logger:
 
 		# Create a handler for console logs
 		self.console_handler = logging.StreamHandler()
-		self.console_handler.setLevel(logging.DEBUG)
+		self.console_handler.setLevel(self.console_level)
+		if self.sample > 1:
+			self.console_handler.addFilter(SampleFilter(self.sample))
 
 		# Define a format for the logger
 		self.file_handler.setFormatter(self.format)
 		self.console_handler.setFormatter(self.format)
 
-		# Make logger use both handlers
-		self.logger.addHandler(self.file_handler)
-		self.logger.addHandler(self.console_handler)
+		if not self.queued:
+			# Make logger use both handlers
+			self.logger.addHandler(self.file_handler)
+			self.logger.addHandler(self.console_handler)
+			return
+
+		# The logger only puts records on a queue, and a listener thread hands them to both handlers.
+		# File writes are buffered until an INFO or higher record comes in, or the buffer fills up.
+		self.buffer_handler = MemoryHandler(1024, flushLevel=logging.INFO, target=self.file_handler)
+		queue = SimpleQueue()
+		self.logger.addHandler(DeferredQueueHandler(queue))
+		self.listener = QueueListener(queue, self.buffer_handler, self.console_handler, respect_handler_level=True)
+		self.listener.start()
+		atexit.register(self.stop)
+
+	# Writes out whatever is still queued or buffered
+	def stop(self):
+		if self.listener is not None:
+			self.listener.stop()
+			self.listener = None
+			self.buffer_handler.close()
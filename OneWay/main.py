@@ -5,20 +5,30 @@ import hashlib
 import time
 import sys
 import signal
+import json
 from datetime import datetime
 from logger import Logger
+from bundle import BundleStore, BUNDLE_DIR, DEFAULT_THRESHOLD, is_packed
 
 logger = None
 counter = 0
 
+# What the source looked like on the previous pass, keyed by (device, inode).
+# Files keep their inode when renamed or moved, which lets us rename the backup instead of copying it again.
+inode_cache = {"files": {}, "dirs": {}}
+
 # Handles Ctrl+C input to exit the program
 def signal_handler(signum, param):
 	logger.info(f"Total number of operations: {counter}\n\n\n")
 	sys.exit(0)
 
 # Simply clears the terminal on startup -- checks the if the system is UNIX-based or Windows
-def clear_terminal():
-	if os.name == "nt":
+# In fast-start mode an ANSI escape sequence is written instead of spawning a shell
+def clear_terminal(fast=False):
+	if fast:
+		sys.stdout.write("\033[2J\033[H")
+		sys.stdout.flush()
+	elif os.name == "nt":
 		os.system('cls')
 	else:
 		os.system('clear')
@@ -67,6 +77,8 @@ def manage_versioned_backups(directory, incoming):
 		if os.path.exists(original):
 			shutil.rmtree(original)
 		shutil.move(current, original)
+		if os.path.exists(manifest_path(current)):
+			os.replace(manifest_path(current), manifest_path(original))
 		logger.info(f"Moved current backup to {original}")
 
 	new_current = current
@@ -77,7 +89,10 @@ def manage_versioned_backups(directory, incoming):
 
 	return current
 
-def sync_directories(source, backup, versioned=False):
+def sync_directories(source, backup, versioned=False, packed=False, threshold=DEFAULT_THRESHOLD):
+	global inode_cache
+	start = time.perf_counter()
+	operations = counter
 	# Get the absolute paths
 	source = os.path.abspath(source)
 	if versioned:
@@ -85,41 +100,78 @@ def sync_directories(source, backup, versioned=False):
 	else:
 		backup = os.path.join(os.path.abspath(backup), f"{os.path.basename(source)}_backup")
 
+	# Small files go into bundles instead of their own backup file
+	store = BundleStore(backup, threshold) if packed else None
+
+	seen = {"files": {}, "dirs": {}}
+	source_files = set()
+
 	# Create or update existing files
 	for root, dirs, files in os.walk(source):
 		# Create the backup folder
 		relative_path = os.path.relpath(root, source)
 		backup_dir = os.path.join(backup, relative_path)
+		dir_stat = os.stat(root)
+		seen["dirs"][inode_key(dir_stat)] = relative_path
 
-		if not os.path.exists(backup_dir):
+		if not os.path.exists(backup_dir) and not move_backup_directory(source, backup, relative_path, dir_stat, store):
 			os.makedirs(backup_dir)
 			count_operations()
-			logger.info(f"Created backup directory: {backup_dir}")
+			logger.debug(f"Created backup directory: {backup_dir}")
 
 		for file in files:
 			source_file = os.path.join(root, file)
 			backup_file = os.path.join(backup_dir, file)
+			relative_file = os.path.relpath(source_file, source)
+			file_stat = os.stat(source_file)
+			entry = {"path": relative_file, "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns, "checksum": None}
+			seen["files"][inode_key(file_stat)] = entry
+
+			# Bundled files never have a regular backup file (strays are removed below), so they cost no extra stat
+			in_store = store is not None and store.contains(relative_file)
+			backup_exists = not in_store and os.path.exists(backup_file)
+
+			# A file that only changed place is renamed inside the backup
+			if not backup_exists and not in_store:
+				previous = move_backup_file(source, backup, relative_file, file_stat, store)
+				if previous:
+					entry["checksum"] = previous["checksum"]
+					continue
+
+			if store:
+				source_files.add(relative_file)
+				entry["checksum"] = sync_packed_file(store, source_file, backup_file, relative_file, file_stat, backup_exists)
+				continue
 
 			# If a file is missing or has changed, sync it
-			if not os.path.exists(backup_file) or file_checksum(source_file) != file_checksum(backup_file):
-				shutil.copy2(source_file, backup_file)
-				count_operations()
-				logger.info(f"Created backup of {file}")
+			if backup_exists:
+				entry["checksum"] = file_checksum(source_file)
+				if entry["checksum"] == file_checksum(backup_file):
+					continue
+			entry["checksum"] = copy_with_checksum(source_file, backup_file)
+			count_operations()
+			logger.debug(f"Created backup of {file}")
 
 	# Remove obsolete files and directories
 	for root, dirs, files in os.walk(backup, topdown=False):
 		relative_path = os.path.relpath(root, backup)
 		source_dir = os.path.join(source, relative_path)
 
+		# The bundles folder has no counterpart in the source
+		if store and (relative_path == BUNDLE_DIR or relative_path.startswith(BUNDLE_DIR + os.sep)):
+			continue
+		if store and relative_path == "." and BUNDLE_DIR in dirs:
+			dirs.remove(BUNDLE_DIR)
+
 		for file in files:
 			backup_file = os.path.join(root, file)
 			source_file = os.path.join(source_dir, file)
 
-			# If a file is missing from source, remove it
-			if not os.path.exists(source_file):
+			# If a file is missing from source, or is now kept in the bundles, remove it
+			if (store and store.contains(os.path.normpath(os.path.join(relative_path, file)))) or not os.path.exists(source_file):
 				os.remove(backup_file)
 				count_operations()
-				logger.info(f"Removed: {backup_file}")
+				logger.debug(f"Removed: {backup_file}")
 
 		for dir in dirs:
 			backup_subdir = os.path.join(root, dir)
@@ -129,16 +181,151 @@ def sync_directories(source, backup, versioned=False):
 			if not os.path.exists(source_subdir):
 				shutil.rmtree(backup_subdir)
 				count_operations()
-				logger.info(f"Removed directory: {backup_subdir}")
+				logger.debug(f"Removed directory: {backup_subdir}")
+
+	if store:
+		# Drop bundled files that are missing from source
+		for relative_file in store.get_files():
+			if relative_file not in source_files:
+				store.remove(relative_file)
+				count_operations()
+				logger.debug(f"Removed: {os.path.join(backup, relative_file)}")
+		store.compact()
+		store.close()
+
+	if versioned:
+		write_manifest(source, backup, seen)
+
+	inode_cache = seen
+	logger.info(f"Sync pass done: {counter - operations} operations in {time.perf_counter() - start:.3f}s")
+
+# Same value as datetime.fromtimestamp(os.path.getmtime(file)).isoformat(), which the scrub mode compares against,
+# but built from the st_mtime_ns already recorded: os.stat computes st_mtime as seconds + nanoseconds * 1e-9.
+def mtime_timestamp(mtime_ns):
+	seconds, nanoseconds = divmod(mtime_ns, 1000000000)
+	return datetime.fromtimestamp(seconds + nanoseconds * 1e-9).isoformat()
+
+def manifest_path(version):
+	return f"{version}.manifest.json"
+
+# Each version folder gets a manifest next to it with the checksum and modification time of every file.
+# The Two-Way scrub mode uses it to find bit-rot in the versioned backups without rehashing them on every pass.
+def write_manifest(source, backup, seen):
+	manifest = {}
+	for entry in seen["files"].values():
+		source_file = os.path.join(source, entry["path"])
+		manifest[entry["path"]] = {
+			"checksum": entry["checksum"] or file_checksum(source_file),
+			"timestamp": mtime_timestamp(entry["mtime"])
+		}
+
+	temp_file = manifest_path(backup) + ".tmp"
+	with open(temp_file, 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, ensure_ascii=False)
+	os.replace(temp_file, manifest_path(backup))
+
+def inode_key(stat):
+	return (stat.st_dev, stat.st_ino)
+
+# If a folder that is new to the backup has the inode of a folder that disappeared from the source,
+# it was renamed or moved, so its backup is renamed as a whole.
+def move_backup_directory(source, backup, relative_path, stat, store):
+	previous = inode_cache["dirs"].get(inode_key(stat))
+	if previous is None or previous in (".", relative_path) or os.path.exists(os.path.join(source, previous)):
+		return False
+
+	old_backup_dir = os.path.join(backup, previous)
+	if not os.path.isdir(old_backup_dir):
+		return False
+
+	backup_dir = os.path.join(backup, relative_path)
+	os.makedirs(os.path.dirname(backup_dir), exist_ok=True)
+	os.rename(old_backup_dir, backup_dir)
+	if store:
+		store.move_tree(previous, relative_path)
+	count_operations()
+	logger.debug(f"Moved backup directory: {old_backup_dir} -> {backup_dir}")
+	return True
 
+# Same idea for single files, but the size and mtime must also match what was recorded,
+# and the content hash too when we have it, before trusting the inode.
+def move_backup_file(source, backup, relative_file, stat, store):
+	previous = inode_cache["files"].get(inode_key(stat))
+	if previous is None or previous["path"] == relative_file or os.path.exists(os.path.join(source, previous["path"])):
+		return None
+	if previous["size"] != stat.st_size or previous["mtime"] != stat.st_mtime_ns:
+		return None
+	if previous["checksum"] is not None and previous["checksum"] != file_checksum(os.path.join(source, relative_file)):
+		return None
+
+	old_backup_file = os.path.join(backup, previous["path"])
+	backup_file = os.path.join(backup, relative_file)
+	if store and store.contains(previous["path"]):
+		store.move(previous["path"], relative_file)
+	elif os.path.isfile(old_backup_file):
+		os.rename(old_backup_file, backup_file)
+	else:
+		return None
+	count_operations()
+	logger.debug(f"Moved backup of {os.path.basename(backup_file)}: {old_backup_file} -> {backup_file}")
+	return previous
+
+# Packed mode: small files live in the bundles, bigger ones stay as regular files.
+# A file that crosses the threshold in either direction is moved to the other side.
+# Returns the checksum of the source file when it's known without extra reads, None otherwise.
+def sync_packed_file(store, source_file, backup_file, relative_file, stat, backup_exists):
+	if store.is_small(stat.st_size):
+		if store.is_current(relative_file, stat):
+			return store.get_entry(relative_file)["checksum"]
+		if store.contains(relative_file):
+			source_checksum = file_checksum(source_file)
+			if store.get_entry(relative_file)["checksum"] == source_checksum:
+				return source_checksum
+		store.add(relative_file, source_file, stat)
+		count_operations()
+		logger.debug(f"Packed backup of {os.path.basename(source_file)}")
+		return store.get_entry(relative_file)["checksum"]
+
+	store.remove(relative_file)
+	if backup_exists:
+		source_checksum = file_checksum(source_file)
+		if source_checksum == file_checksum(backup_file):
+			return source_checksum
+	source_checksum = copy_with_checksum(source_file, backup_file)
+	count_operations()
+	logger.debug(f"Created backup of {os.path.basename(source_file)}")
+	return source_checksum
+
+# Rebuilds a regular directory from a packed backup
+def unpack_backup(backup, target):
+	backup = os.path.abspath(backup)
+	target = os.path.abspath(target)
+	if not is_packed(backup):
+		logger.error(f"Not a packed backup: {backup}")
+		sys.exit(1)
+	store = BundleStore(backup)
+	store.restore(target)
+	logger.info(f"Unpacked {len(store.get_files())} bundled files from {backup} into {target}")
+
+# Packed backups are hashed as if they were unpacked, so they compare equal to their source
 def directory_checksum(directory):
 	hasher = hashlib.sha256()
-	for root, _, files in os.walk(directory):
-		for file in sorted(files):
+	bundled = {}
+	if is_packed(directory):
+		for relative_path, entry in BundleStore(directory).index["files"].items():
+			bundled.setdefault(os.path.dirname(relative_path), {})[relative_path] = entry["checksum"]
+
+	for root, dirs, files in os.walk(directory):
+		if root == directory and BUNDLE_DIR in dirs:
+			dirs.remove(BUNDLE_DIR)
+		relative_root = os.path.relpath(root, directory)
+		checksums = bundled.get("" if relative_root == "." else relative_root, {})
+		for file in files:
 			file_path = os.path.join(root, file)
-			relative_path = os.path.relpath(file_path, directory)
+			checksums[os.path.relpath(file_path, directory)] = file_checksum(file_path)
+		for relative_path in sorted(checksums, key=os.path.basename):
 			hasher.update(relative_path.encode())
-			hasher.update(file_checksum(file_path).encode())
+			hasher.update(checksums[relative_path].encode())
 	return hasher.hexdigest()
 
 # Using the MD5 algorithm, we create a 128-bit hash.
@@ -151,12 +338,24 @@ def	file_checksum(file):
 			file_hash.update(chunk)
 	return file_hash.hexdigest()
 
+# Copies like shutil.copy2 but hashes the data on the way through,
+# so the checksum of a freshly copied file is known without reading it again
+def copy_with_checksum(source_file, backup_file):
+	file_hash = hashlib.sha256()
+	with open(source_file, "rb") as src, open(backup_file, "wb") as dst:
+		for chunk in iter(lambda: src.read(65536), b""):
+			file_hash.update(chunk)
+			dst.write(chunk)
+	shutil.copystat(source_file, backup_file)
+	return file_hash.hexdigest()
+
 def count_operations():
 	global counter
 	counter += 1
 
 def main():
 	global logger
+	start_time = time.perf_counter()
 	signal.signal(signal.SIGINT, signal_handler)
 
 	# Read from CLI
@@ -166,15 +365,32 @@ def main():
 	parser.add_argument('-i', '--interval', type=int, default=3600, help='Synchronization interval in seconds (default: 3600)')
 	parser.add_argument('-l', '--log', type=str, default="oneway.log", help='Path to the log file (default: synchro.log)')
 	parser.add_argument('-v', '--versioned-backup', action='store_true', help='Create versioned backup')
+	parser.add_argument('-p', '--packed', action='store_true', help='Pack small files into bundle files inside the backup')
+	parser.add_argument('--pack-threshold', type=int, default=DEFAULT_THRESHOLD, help=f'Files smaller than this many bytes are packed (default: {DEFAULT_THRESHOLD})')
+	parser.add_argument('--unpack', action='store_true', help='Restore the packed backup given as source into the backup path, then exit')
+	parser.add_argument('--fast-start', action='store_true', help='Skip the shell call used to clear the terminal on startup')
+	parser.add_argument('--defer-initial', action='store_true', help='Wait one interval before the first sync instead of syncing on startup')
+	parser.add_argument('--async-log', action='store_true', help='Log through a background thread and batch the writes to the log file')
+	parser.add_argument('--console-level', type=str.upper, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG', help='Lowest level shown on the console, per-file events are DEBUG (default: DEBUG)')
+	parser.add_argument('--log-sample', type=int, default=1, help='Only show one in every N per-file events on the console (default: 1)')
 	args = parser.parse_args()
-
-	clear_terminal()
+	if args.log_sample < 1:
+		parser.error("--log-sample must be at least 1")
 
 	source = args.source
 	backup = args.backup
 	timer = args.interval
 	versioned = args.versioned_backup
-	logger = Logger(args.log).get_logger()
+	packed = args.packed
+	threshold = args.pack_threshold
+	logger = Logger(args.log, queued=args.async_log, console_level=args.console_level, sample=args.log_sample).get_logger()
+
+	# Unpacking is run from the Two-Way restore, so it must leave the terminal alone
+	if args.unpack:
+		unpack_backup(source, backup)
+		sys.exit(0)
+
+	clear_terminal(fast=args.fast_start)
 
 	# Check if paths exist
 	source_exists = does_path_exist(source, "source")
@@ -187,13 +403,19 @@ def main():
 	if is_subdirectory_of_source(source, backup):
 		logger.error("The backup folder is inside the source folder or its subdirectories.")
 		sys.exit(1)
+	elif args.defer_initial:
+		# Started next to a program that just made its own full pass, so don't compete with it right away
+		logger.info(f"Deferring the first sync by {timer}s")
 	else:
 		logger.info("Synching...")
-		sync_directories(source, backup, versioned=versioned)
+		sync_directories(source, backup, versioned=versioned, packed=packed, threshold=threshold)
+
+	logger.info(f"Ready in {time.perf_counter() - start_time:.3f}s")
 
+	# The initial sync just ran (or was deferred), so wait for the next interval before going again
 	while True:
-		sync_directories(source, backup, versioned=versioned)
 		time.sleep(timer)
+		sync_directories(source, backup, versioned=versioned, packed=packed, threshold=threshold)
 
 if __name__ == "__main__":
 	main()
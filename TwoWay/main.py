@@ -7,21 +7,30 @@ import subprocess
 from logger import Logger
 from synchronizer import FolderSynchronizer
 from recovery import RestoreSystem
+from scrubber import Scrubber
 
 logger = None
 sync = None
 restore_manager = None
+scrubber = None
+start_time = None
 
 # Handles Ctrl+C input to exit the program
 def signal_handler(signum, param):
 	logger.get_logger().info(f"Total number of operations: {sync.counter if sync else 'N/A'}\n\n\n")
 	if restore_manager:
 		restore_manager.cleanup()
+	if scrubber:
+		scrubber.cleanup()
 	sys.exit(0)
 
 # Simply clears the terminal on startup -- checks the if the system is UNIX-based or Windows
-def clear_terminal():
-	if os.name == "nt":
+# In fast-start mode an ANSI escape sequence is written instead of spawning a shell
+def clear_terminal(fast=False):
+	if fast:
+		sys.stdout.write("\033[2J\033[H")
+		sys.stdout.flush()
+	elif os.name == "nt":
 		os.system('cls')
 	else:
 		os.system('clear')
@@ -58,10 +67,30 @@ def parse_arguments():
 	parser.add_argument('--interval', type=int, default=3600, help='Synchronization interval in seconds (default: 3600)')
 	parser.add_argument('--log', type=str, default="twoway.log", help='Path to the log file (default: synchro.log)')
 	parser.add_argument('--config', type=str, default="config.json", help="Path to the recovery system configuration file")
-	return parser.parse_args()
+	parser.add_argument('--scrub', action="store_true", help="Verify the backup and the versioned backups against their recorded checksums")
+	parser.add_argument('--sample-rate', type=float, default=1.0, help="Fraction of the files checked on each scrub run (default: 1.0)")
+	parser.add_argument('--scrub-budget', type=int, default=60, help="Time budget of each scrub run in seconds, the next run resumes where it stopped (default: 60)")
+	parser.add_argument('--scrub-interval', type=int, default=0, help="Start a low priority scrub in the background every N seconds while synchronizing (default: 0, disabled)")
+	parser.add_argument('--async-log', action='store_true', help='Log through a background thread and batch the writes to the log file')
+	parser.add_argument('--console-level', type=str.upper, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG', help='Lowest level shown on the console, per-file events are DEBUG (default: DEBUG)')
+	parser.add_argument('--log-sample', type=int, default=1, help='Only show one in every N per-file events on the console (default: 1)')
+	parser.add_argument('--fast-start', action='store_true', help="Start the synchronization loop right away and defer the versioned backups until after the first pass")
+	args = parser.parse_args()
+
+	# Checked here so the standalone and the scheduled scrub both get them
+	if not 0 < args.sample_rate <= 1:
+		parser.error("--sample-rate must be greater than 0 and at most 1")
+	if args.scrub_budget <= 0:
+		parser.error("--scrub-budget must be a positive number of seconds")
+	if args.scrub_interval < 0:
+		parser.error("--scrub-interval can't be negative")
+	if args.log_sample < 1:
+		parser.error("--log-sample must be at least 1")
+	return args
 
 def handle_sync(args):
 	global sync
+	global scrubber
 	source_exists = does_path_exist(args.source, "source")
 	backup_exists = does_path_exist(args.backup, "backup")
 
@@ -73,13 +102,25 @@ def handle_sync(args):
 		logger.get_logger().error("The backup folder is inside the source folder or its subdirectories.")
 		sys.exit(1)
 
+	sync = FolderSynchronizer(logger, args.source, args.backup, args.interval)
+	scrubber = Scrubber(restore_manager, logger, args.sample_rate, args.scrub_budget, args.scrub_interval) if args.scrub_interval > 0 else None
+
+	# The first pass of the loop does the initial sync from the source, and the versioned backups only start once it's done
+	if args.fast_start:
+		def after_first_pass():
+			logger.get_logger().info(f"Ready in {time.perf_counter() - start_time:.3f}s (fast start)")
+			restore_manager.run_versioned_backups()
+
+		sync.run(first_pass=sync.sync_by_source, after_first_pass=after_first_pass, scrubber=scrubber)
+		return
+
 	# Create the backup first
 	logger.get_logger().info("Synching...")
-	sync = FolderSynchronizer(logger, args.source, args.backup, args.interval)
 	sync.sync_by_source()
 
 	restore_manager.run_versioned_backups()
-	sync.run()
+	logger.get_logger().info(f"Ready in {time.perf_counter() - start_time:.3f}s")
+	sync.run(initial_delay=True, scrubber=scrubber)
 
 def handle_restore(args, version):
 	if args.backup:
@@ -100,21 +141,43 @@ def handle_restore(args, version):
 		restore_manager.restore_version(recorded_path, version=version)
 		logger.get_logger().info(f"Restored from backup to {recorded_path}")
 
+def handle_scrub(args):
+	if args.backup:
+		logger.get_logger().error("The --scrub option requires only one directory argument.")
+		sys.exit(1)
+
+	# Scrubbing is background work, so stay out of the way of everything else.
+	# Scheduled scrubs run through here too, as a separate process started by the synchronization loop.
+	if hasattr(os, "nice"):
+		os.nice(10)
+
+	scrubber = Scrubber(restore_manager, logger, args.sample_rate, args.scrub_budget)
+	if scrubber.run() > 0:
+		sys.exit(1)
+
 def main():
 	global logger
 	global restore_manager
+	global start_time
+	start_time = time.perf_counter()
 	signal.signal(signal.SIGINT, signal_handler)
 
 	args = parse_arguments()
 
-	clear_terminal()
+	# Scheduled scrubs share the daemon's terminal, so scrub mode leaves it alone
+	if not args.scrub:
+		clear_terminal(fast=args.fast_start)
 
-	logger = Logger(args.log)
-	restore_manager = RestoreSystem(args.source, logger, config=args.config)
+	logger = Logger(args.log, queued=args.async_log, console_level=args.console_level, sample=args.log_sample)
+	log_flags = ["--console-level", args.console_level, "--log-sample", str(args.log_sample)] + (["--async-log"] if args.async_log else [])
+	restore_manager = RestoreSystem(args.source, logger, config=args.config, lazy=args.fast_start and not args.restore and not args.scrub, log_flags=log_flags)
 
 	if args.restore:
 		handle_restore(args, args.version)
 
+	elif args.scrub:
+		handle_scrub(args)
+
 	elif not args.backup:
 		logger.get_logger().error("The program requires a backup directory.")
 		sys.exit(1)
@@ -10,9 +10,13 @@ class RestoreSystem:
 	DEFAULT = {
 		"script": "../OneWay/main.py",
 		"interval": ["--interval", "60"],
+		"packed": False,
 	}
 
-	def __init__(self, origin, logger, config="config.json"):
+	# With lazy=True the config and the recorded paths are only loaded once the versioned backups are started,
+	# and the One-Way processes are started in fast-start mode with their first pass deferred by one interval
+	# log_flags are the logging options passed on to the One-Way processes, since they share our console
+	def __init__(self, origin, logger, config="config.json", lazy=False, log_flags=None):
 		self.origin = origin
 		self.logger = logger
 		self.log = logger.get_logger()
@@ -28,15 +32,24 @@ class RestoreSystem:
 		self.source_logs = ["--log", f"./__versions__/{self.origin}/versionlogs.log"]
 		self.backup_logs = ["--log", f"./__versions__/{self.origin}_backup/versionlogs.log"]
 		self.version_flag = "--versioned-backup"
+		self.fast_start_flag = "--fast-start"
+		self.defer_flag = "--defer-initial"
+		self.packed_flag = "--packed"
+		self.unpack_flag = "--unpack"
+		self.bundle_dir = ".bundles"
 		#DEFAULT
 		self.config = config
 		self.script = self.DEFAULT["script"]
 		self.interval = self.DEFAULT["interval"]
+		self.packed = self.DEFAULT["packed"]
 		self.restore_source_process = None
 		self.restore_backup_process = None
+		self.lazy = lazy
+		self.log_flags = log_flags or []
+		self.loaded = False
 		#LOAD CONFIG
-		self.load_config()
-		self.record_paths()
+		if not self.lazy:
+			self.prepare()
 
 	def get_versions(self):
 		return self.versions
@@ -44,6 +57,13 @@ class RestoreSystem:
 	def get_config(self):
 		return self.config
 
+	def prepare(self):
+		if self.loaded:
+			return
+		self.load_config()
+		self.record_paths()
+		self.loaded = True
+
 	def create_default_config(self):
 		with open(self.config, 'w') as f:
 			json.dump(self.DEFAULT, f, indent=4)
@@ -58,6 +78,7 @@ class RestoreSystem:
 
 		self.script = config.get("script", self.DEFAULT["script"])
 		self.interval = config.get("interval", self.DEFAULT["interval"])
+		self.packed = config.get("packed", self.DEFAULT["packed"])
 
 	def record_paths(self):
 		data = {}
@@ -66,11 +87,16 @@ class RestoreSystem:
 			with open(self.info_file, 'r') as f:
 				data = json.load(f)
 
+		recorded = dict(data)
 		data[f"{self.origin}"] = os.path.abspath(self.origin)
 		backup_path = f"{self.origin}_backup"
 		if os.path.exists(backup_path):
 			data[f"{self.origin}_backup"] = os.path.abspath(backup_path)
 
+		# Nothing new to record, so don't rewrite the file
+		if data == recorded:
+			return
+
 		with open(self.info_file, 'w') as f:
 			json.dump(data, f, indent=4, ensure_ascii=False)
 
@@ -87,6 +113,7 @@ class RestoreSystem:
 		return None
 
 	def run_versioned_backups(self):
+		self.prepare()
 		if not os.path.exists(self.versions):
 			os.makedirs(self.versions)
 		if not os.path.exists(self.versions_source):
@@ -94,11 +121,15 @@ class RestoreSystem:
 		if not os.path.exists(self.versions_backup):
 			os.makedirs(self.versions_backup)
 
-		command = [self.compiler, self.script, self.origin, self.versions_source, self.version_flag] + self.interval + self.source_logs
+		flags = ([self.packed_flag] if self.packed else []) + self.log_flags
+		if self.lazy:
+			flags += [self.fast_start_flag, self.defer_flag]
+
+		command = [self.compiler, self.script, self.origin, self.versions_source, self.version_flag] + flags + self.interval + self.source_logs
 		self.log.info(f"Running versioned backup: {command}")
 		self.restore_source_process = subprocess.Popen(command)
 
-		command = [self.compiler, self.script, self.origin, self.versions_backup, self.version_flag] + self.interval + self.backup_logs
+		command = [self.compiler, self.script, self.origin, self.versions_backup, self.version_flag] + flags + self.interval + self.backup_logs
 		self.log.info(f"Running versioned backup: {command}")
 		self.restore_backup_process = subprocess.Popen(command)
 
@@ -135,6 +166,13 @@ class RestoreSystem:
 		if os.path.exists(target):
 			shutil.rmtree(target)
 
+		# Packed versions can only be read back by the One-Way program
+		if os.path.isdir(os.path.join(backup_path, self.bundle_dir)):
+			command = [self.compiler, self.script, backup_path, target, self.unpack_flag]
+			self.log.info(f"Unpacking versioned backup: {command}")
+			subprocess.run(command, check=True)
+			return
+
 		#os.makedirs(target)
 		shutil.copytree(backup_path, target)
 
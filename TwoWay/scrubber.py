@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import subprocess
+from datetime import datetime
+
+# Scrub mode.
+# Re-reads what is stored in the backup and in the versioned backups and compares it with the checksums
+# recorded when it was written: the metadata journal for the backup, and the manifests written by the
+# One-Way program for each version. Each run works through a slice of the files within a time budget,
+# optionally sampling them, and picks up where the previous run stopped.
+class Scrubber:
+
+	def __init__(self, restore_manager, logger, sample_rate=1.0, time_budget=60, interval=0):
+		self.restore_manager = restore_manager
+		self.logger = logger
+		self.log = logger.get_logger()
+		self.origin = restore_manager.origin
+		self.sample_rate = sample_rate
+		self.time_budget = time_budget
+		self.interval = interval
+		self.state_file = ".scrub.json"
+		self.bundle_dir = ".bundles"
+		self.last_run = time.monotonic()
+		self.process = None
+
+	def get_sample_rate(self):
+		return self.sample_rate
+
+	def get_time_budget(self):
+		return self.time_budget
+
+	def get_interval(self):
+		return self.interval
+
+	def get_state_file(self):
+		return self.state_file
+
+	def load_state(self):
+		if not os.path.exists(self.state_file):
+			return {}
+		with open(self.state_file, 'r', encoding='utf-8') as f:
+			return json.load(f)
+
+	def save_state(self, state):
+		with open(self.state_file, 'w', encoding='utf-8') as f:
+			json.dump(state, f, indent=4, ensure_ascii=False)
+
+	# Replays the journal to know what the backup should hold right now
+	def load_journal(self):
+		metadata_file = self.logger.get_metadata_file()
+		if not os.path.exists(metadata_file):
+			return {}
+
+		with open(metadata_file, 'r') as f:
+			data = json.load(f)
+
+		expected = {}
+		for entry in data:
+			path = entry['path']
+			if entry['change_type'] == "MOVE":
+				previous = entry['previous_path']
+				for key in [key for key in expected if key == previous or key.startswith(previous + os.sep)]:
+					expected[path + key[len(previous):]] = expected.pop(key)
+			elif entry['change_type'] == "DELETE" or entry['checksum'] is None:
+				for key in [key for key in expected if key == path or key.startswith(path + os.sep)]:
+					expected.pop(key)
+				continue
+			if entry['checksum'] is not None:
+				expected[path] = {"checksum": entry['checksum'], "timestamp": entry['timestamp']}
+		return expected
+
+	def load_manifest(self, version):
+		manifest = f"{version}.manifest.json"
+		if not os.path.exists(manifest):
+			return {}
+		with open(manifest, 'r', encoding='utf-8') as f:
+			return json.load(f)
+
+	# Every store is a folder plus the checksums it's expected to hold
+	def get_stores(self):
+		manager = self.restore_manager
+		stores = [(f"{self.origin}_backup", self.load_journal())]
+		for version in [manager.versions_source_latest, manager.versions_source_previous, manager.versions_backup_latest, manager.versions_backup_previous]:
+			stores.append((version, self.load_manifest(version)))
+		return [(root, expected) for root, expected in stores if os.path.isdir(root) and expected]
+
+	def load_bundle_index(self, root):
+		index_file = os.path.join(root, self.bundle_dir, "index.json")
+		if not os.path.exists(index_file):
+			return {}
+		with open(index_file, 'r', encoding='utf-8') as f:
+			return json.load(f)["files"]
+
+	def file_checksum(self, file):
+		file_hash = hashlib.sha256()
+		with open(file, "rb") as f:
+			for chunk in iter(lambda: f.read(4096), b""):
+				file_hash.update(chunk)
+		return file_hash.hexdigest()
+
+	# Returns "ok", "corrupted", "missing" or "stale".
+	# A file whose modification time no longer matches the record was changed on purpose after it was written
+	# (e.g. edited on the backup side), so only files that still claim to be the recorded version are judged.
+	def verify(self, root, path, record, bundles):
+		file_path = os.path.join(root, path)
+		if os.path.isfile(file_path):
+			if datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat() != record["timestamp"]:
+				return "stale"
+			checksum = self.file_checksum(file_path)
+		elif path in bundles:
+			entry = bundles[path]
+			with open(os.path.join(root, self.bundle_dir, entry["bundle"]), "rb") as f:
+				f.seek(entry["offset"])
+				checksum = hashlib.sha256(f.read(entry["size"])).hexdigest()
+		else:
+			return "missing"
+		return "ok" if checksum == record["checksum"] else "corrupted"
+
+	def run(self):
+		deadline = time.monotonic() + self.time_budget
+		self.last_run = time.monotonic()
+		stores = self.get_stores()
+		if not stores:
+			self.log.info("Scrub: nothing recorded to verify yet")
+			return 0
+
+		# Resume from the store and file the previous run stopped at
+		state = self.load_state()
+		roots = [root for root, _ in stores]
+		first = roots.index(state["store"]) if state.get("store") in roots else 0
+		cursor = state.get("cursor") if state.get("store") in roots else None
+
+		results = {"ok": 0, "corrupted": 0, "missing": 0, "stale": 0}
+		skipped = 0
+		for root, expected in stores[first:] + stores[:first]:
+			bundles = self.load_bundle_index(root)
+			for path in sorted(expected):
+				if cursor is not None and path <= cursor:
+					continue
+				if time.monotonic() >= deadline:
+					self.save_state({"store": root, "cursor": cursor})
+					self.log.info(f"Scrub: time budget reached in {root}, the next run resumes from there")
+					self.report(results, skipped)
+					return results["corrupted"]
+
+				cursor = path
+				if random.random() >= self.sample_rate:
+					skipped += 1
+					continue
+
+				result = self.verify(root, path, expected[path], bundles)
+				results[result] += 1
+				if result == "corrupted":
+					self.log.error(f"Scrub: checksum mismatch in {os.path.join(root, path)}")
+				elif result == "missing":
+					self.log.warning(f"Scrub: missing from {root}: {path}")
+			cursor = None
+
+		self.save_state({})
+		self.log.info("Scrub: completed a full cycle")
+		self.report(results, skipped)
+		return results["corrupted"]
+
+	def report(self, results, skipped):
+		self.log.info(f"Scrub: {results['ok']} ok, {results['corrupted']} corrupted, {results['missing']} missing, {results['stale']} changed since recorded, {skipped} skipped by sampling")
+
+	# Called from the synchronization loop so scrubbing happens on a schedule.
+	# Each slice runs in its own Two-Way process in --scrub mode, which lowers its own priority,
+	# so synchronization never waits for it. A new slice isn't started while the previous one is still running.
+	def run_if_due(self):
+		if self.process is not None:
+			if self.process.poll() is None:
+				return
+			if self.process.returncode != 0:
+				self.log.warning(f"Scrub: the last scheduled run exited with status {self.process.returncode}, check the log for corrupted files")
+			self.process = None
+
+		if self.interval <= 0 or time.monotonic() - self.last_run < self.interval:
+			return
+
+		self.last_run = time.monotonic()
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+		command = [self.restore_manager.compiler, script, self.origin, "--scrub",
+			"--sample-rate", str(self.sample_rate), "--scrub-budget", str(self.time_budget),
+			"--config", self.restore_manager.get_config(), "--log", self.logger.get_log_file()] + self.restore_manager.log_flags
+		self.log.info(f"Running scheduled scrub: {command}")
+		self.process = subprocess.Popen(command)
+
+	def cleanup(self):
+		if self.process and self.process.poll() is None:
+			self.process.terminate()
+			try:
+				self.process.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
@@ -17,6 +17,12 @@ class FolderSynchronizer:
 		self.backup = backup
 		self.timer = timer
 		self.counter = 0
+		# What each side looked like on its previous pass, keyed by (device, inode).
+		# Files keep their inode when renamed or moved, which lets us rename the copy instead of transferring it again.
+		self.inode_cache = {
+			ORIGIN[1]: {"files": {}, "dirs": {}},
+			ORIGIN[2]: {"files": {}, "dirs": {}}
+		}
 
 	def get_logger(self):
 		return self.logger
@@ -60,7 +66,52 @@ class FolderSynchronizer:
 	def count_operations(self):
 		self.counter += 1
 
+	def inode_key(self, stat):
+		return (stat.st_dev, stat.st_ino)
+
+	# If a folder that is new to the backup has the inode of a folder that disappeared from the source,
+	# it was renamed or moved, so its copy is renamed as a whole.
+	def move_directory(self, source, backup, relative_path, stat, origin):
+		previous = self.inode_cache[origin]["dirs"].get(self.inode_key(stat))
+		if previous is None or previous in (".", relative_path) or os.path.exists(os.path.join(source, previous)):
+			return False
+
+		old_backup_dir = os.path.join(backup, previous)
+		if not os.path.isdir(old_backup_dir):
+			return False
+
+		backup_dir = os.path.join(backup, relative_path)
+		os.makedirs(os.path.dirname(backup_dir), exist_ok=True)
+		os.rename(old_backup_dir, backup_dir)
+		self.count_operations()
+		self.logger.log_metadata(file_path=os.path.join(source, relative_path), change_type="MOVE", root=source, previous_path=previous)
+		self.log.debug(f"Moved directory: {previous} -> {relative_path}")
+		return True
+
+	# Same idea for single files, but the size and mtime must also match what was recorded,
+	# and the content hash too when we have it, before trusting the inode.
+	def move_file(self, source, backup, relative_file, stat, origin):
+		previous = self.inode_cache[origin]["files"].get(self.inode_key(stat))
+		if previous is None or previous["path"] == relative_file or os.path.exists(os.path.join(source, previous["path"])):
+			return None
+		if previous["size"] != stat.st_size or previous["mtime"] != stat.st_mtime_ns:
+			return None
+		source_file = os.path.join(source, relative_file)
+		if previous["checksum"] is not None and previous["checksum"] != self.file_checksum(source_file):
+			return None
+
+		old_backup_file = os.path.join(backup, previous["path"])
+		if not os.path.isfile(old_backup_file):
+			return None
+		os.rename(old_backup_file, os.path.join(backup, relative_file))
+		self.count_operations()
+		self.logger.log_metadata(file_path=source_file, change_type="MOVE", root=source, previous_path=previous["path"])
+		self.log.debug(f"Moved: {previous['path']} -> {relative_file}")
+		return previous
+
 	def sync_directories(self, source, backup, origin):
+		start = time.perf_counter()
+		operations = self.counter
 
 		# Get the absolute paths
 		source = os.path.abspath(source)
@@ -71,28 +122,49 @@ class FolderSynchronizer:
 		else:
 			backup = os.path.abspath(backup)
 
+		seen = {"files": {}, "dirs": {}}
+
 		# Create or update existing files
 		for root, dirs, files in os.walk(source):
 			# Create the backup folder
 			relative_path = os.path.relpath(root, source)
 			backup_dir = os.path.join(backup, relative_path)
+			dir_stat = os.stat(root)
+			seen["dirs"][self.inode_key(dir_stat)] = relative_path
 
-			# Only create the _backup folder if it doesn't exist and we're synching from the source folder
-			if not os.path.exists(backup_dir) and not origin == ORIGIN[2]:
+			# Only create the _backup folder if it doesn't exist, wasn't just moved, and we're synching from the source folder
+			if not os.path.exists(backup_dir) and not self.move_directory(source, backup, relative_path, dir_stat, origin) and not origin == ORIGIN[2]:
 				os.makedirs(backup_dir)
 				self.count_operations()
 				#self.logger.log_metadata(file_path=backup_dir, change_type="CREATE")
-				self.log.info(f"Created backup directory: {os.path.basename(backup_dir)}")
+				self.log.debug(f"Created backup directory: {os.path.basename(backup_dir)}")
 
 			for file in files:
 				source_file = os.path.join(root, file)
 				backup_file = os.path.join(backup_dir, file)
+				relative_file = os.path.relpath(source_file, source)
+				file_stat = os.stat(source_file)
+				entry = {"path": relative_file, "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns, "checksum": None}
+				seen["files"][self.inode_key(file_stat)] = entry
+
+				# A file that only changed place is renamed on the other side
+				backup_exists = os.path.exists(backup_file)
+				if not backup_exists:
+					previous = self.move_file(source, backup, relative_file, file_stat, origin)
+					if previous:
+						entry["checksum"] = previous["checksum"]
+						continue
+
 				# If a file is missing or has changed, sync it
-				if not os.path.exists(backup_file) or self.file_checksum(source_file) != self.file_checksum(backup_file):
-					shutil.copy2(source_file, backup_file)
-					self.count_operations()
-					self.logger.log_metadata(file_path=source_file, change_type="UPDATE", root=source)
-					self.log.info(f"Created backup of {os.path.basename(source_file)}")
+				if backup_exists:
+					entry["checksum"] = self.file_checksum(source_file)
+					if entry["checksum"] == self.file_checksum(backup_file):
+						continue
+				shutil.copy2(source_file, backup_file)
+				self.count_operations()
+				# The journal hashes the copied file anyway, so keep that checksum for move detection
+				entry["checksum"] = self.logger.log_metadata(file_path=source_file, change_type="UPDATE", root=source)
+				self.log.debug(f"Created backup of {os.path.basename(source_file)}")
 
 		# Remove obsolete files and directories
 		for root, dirs, files in os.walk(backup, topdown=False):
@@ -105,10 +177,10 @@ class FolderSynchronizer:
 
 				# If a file is missing from source, remove it
 				if not os.path.exists(source_file):
-					self.logger.log_metadata(file_path=backup_file, change_type="DELETE", root=source)
+					self.logger.log_metadata(file_path=backup_file, change_type="DELETE", root=backup)
 					os.remove(backup_file)
 					self.count_operations()
-					self.log.info(f"Removed: {os.path.relpath(backup_file, root)}")
+					self.log.debug(f"Removed: {os.path.relpath(backup_file, root)}")
 
 			for dir in dirs:
 				backup_subdir = os.path.join(root, dir)
@@ -116,22 +188,41 @@ class FolderSynchronizer:
 
 				# If a directory is missing from source, remove it
 				if not os.path.exists(source_subdir):
-					self.logger.log_metadata(file_path=backup_subdir, change_type="UPDATE", root=source)
+					self.logger.log_metadata(file_path=backup_subdir, change_type="UPDATE", root=backup)
 					shutil.rmtree(backup_subdir)
 					self.count_operations()
-					self.log.info(f"Removed directory: {os.path.relpath(backup_subdir, root)}")
+					self.log.debug(f"Removed directory: {os.path.relpath(backup_subdir, root)}")
+
+		self.inode_cache[origin] = seen
+		self.log.info(f"Sync pass from {origin.lower()} done: {self.counter - operations} operations in {time.perf_counter() - start:.3f}s")
+
+	# initial_delay skips the first pass when a full sync was just made,
+	# first_pass replaces the direction check on the first pass (the initial sync must always come from the source),
+	# after_first_pass runs once the first pass is done (used to start deferred work),
+	# and the scrubber gets a chance to start its scheduled integrity check (in the background) after every pass.
+	def run(self, initial_delay=False, first_pass=None, after_first_pass=None, scrubber=None):
+		if initial_delay:
+			time.sleep(self.timer)
 
-	def run(self):
 		while True:
 
-			# Check if we're synching from source or backup, depending on the directories last modification time
-			# Instead of checking each individual file and dir, we check the root.
-			# This allows to identify mtime for file deletions and remove files/dirs of the correct directory
-			source_mtime = self.get_lastest_mtime(self.source)
-			backup = self.source+"_backup"
-			backup_mtime = self.get_lastest_mtime(backup)
-			if source_mtime > backup_mtime:
-				self.sync_by_source()
+			if first_pass:
+				first_pass()
+				first_pass = None
 			else:
-				self.sync_by_backup()
+				# Check if we're synching from source or backup, depending on the directories last modification time
+				# Instead of checking each individual file and dir, we check the root.
+				# This allows to identify mtime for file deletions and remove files/dirs of the correct directory
+				source_mtime = self.get_lastest_mtime(self.source)
+				backup = self.source+"_backup"
+				if not os.path.exists(backup) or source_mtime > self.get_lastest_mtime(backup):
+					self.sync_by_source()
+				else:
+					self.sync_by_backup()
+
+			if after_first_pass:
+				after_first_pass()
+				after_first_pass = None
+			if scrubber:
+				scrubber.run_if_due()
 			time.sleep(self.timer)